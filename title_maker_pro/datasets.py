@@ -2,12 +2,14 @@ from dataclasses import dataclass
 import os
 import logging
 import pickle
-import hashlib
+import zlib
 import itertools
+import functools
 import title_maker_pro.custom_modeling_utils as custom_modeling_utils
 import title_maker_pro.dictionary_definition as dictionary_definition
 import re
 import torch
+import numpy as np
 import random
 import stanza
 import time
@@ -139,10 +141,9 @@ def _len_range_overlap(x, y):
 
 
 def _split_range(splits, split_idx):
-    splits_tensor = torch.tensor(splits)
-    sum_splits = torch.cumsum(splits_tensor, 0)
+    sum_splits = list(itertools.accumulate(splits))
 
-    if sum_splits[-1] != 1.0:
+    if abs(sum_splits[-1] - 1.0) > 1e-9:
         raise RuntimeError(f"Splits must sum to 1 (actual: {sum_splits[-1]})")
     elif split_idx >= len(sum_splits):
         raise RuntimeError(f"Invalid split index {split_idx} (must be less than {len(sum_splits)})")
@@ -159,8 +160,8 @@ def _split_range(splits, split_idx):
 
 def _in_split_range(split_range, randomizer_str):
     start_range, end_range = split_range
-    val = int(hashlib.md5(randomizer_str.encode("utf-8")).hexdigest(), 16,) % 100000 / 100000
-    return (val >= start_range and val < end_range).item()
+    val = zlib.crc32(randomizer_str.encode("utf-8")) % 100000 / 100000
+    return start_range <= val < end_range
 
 
 def _cache_path(class_name, base_directory, filename, **keys):
@@ -586,6 +587,7 @@ class ParsedDictionaryDefinitionDataset(Dataset):
             model_type=args.model_type,
             splits=splits,
             split_idx=split_idx,
+            split_hash="crc32",
             max_len=self.max_len,
         )
 
@@ -775,6 +777,7 @@ class InverseParsedDictionaryDefinitionDataset(Dataset):
             model_type=args.model_type,
             splits=splits,
             split_idx=split_idx,
+            split_hash="crc32",
             max_len=self.max_len,
         )
 
@@ -815,24 +818,35 @@ class BinaryDictionaryDefinitionDataset(Dataset):
         return f"<title>{title}</title>"
 
     @classmethod
-    def _make_example(cls, tokenizer, definition):
-        max_len = cls.max_len
-
-        m = re.match(r"\s*" + re.escape(definition.title) + r"\d*\s*(\|[^|]*\|)?\s*", definition.entry_str,)
-        if m:
-            trainable_entry = definition.entry_str[m.span()[1] :].strip()
-            if not trainable_entry:
-                raise RuntimeError(f"Bad entry for {definition.title}: '{definition.entry_str}'")
-        else:
+    def _trainable_entry(cls, definition):
+        # Skip the "<title><variant digits> |<pronounciation>|" prefix of the entry
+        s = definition.entry_str.lstrip()
+        if not s.startswith(definition.title):
             raise RuntimeError(f"Couldn't match {definition.title} on '{definition.entry_str}'")
 
-        tokenized_title = [tokenizer.bos_token_id] + tokenizer.convert_tokens_to_ids(
-            tokenizer.tokenize(cls.title_tokenization(definition.title))
-        )
-        tokenized_entry = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(trainable_entry))
+        i = len(definition.title)
+        while i < len(s) and s[i].isdecimal():
+            i += 1
+        while i < len(s) and s[i].isspace():
+            i += 1
+        if i < len(s) and s[i] == "|":
+            j = s.find("|", i + 1)
+            if j >= 0:
+                i = j + 1
+
+        trainable_entry = s[i:].strip()
+        if not trainable_entry:
+            raise RuntimeError(f"Bad entry for {definition.title}: '{definition.entry_str}'")
+
+        return trainable_entry
+
+    def _make_example(self, tokenizer, title, tokenized_title, tokenized_entry):
+        max_len = self.max_len
+
+        tokenized_title = [tokenizer.bos_token_id] + tokenized_title
 
         if len(tokenized_title) + len(tokenized_entry) > max_len:
-            logger.warn(f"Truncating long entry for '{definition.title}' (entry is {len(tokenized_entry)})")
+            logger.warn(f"Truncating long entry for '{title}' (entry is {len(tokenized_entry)})")
 
         all_tokenized = (tokenized_title + tokenized_entry)[:max_len]
         example = tokenizer.build_inputs_with_special_tokens(all_tokenized)
@@ -841,7 +855,7 @@ class BinaryDictionaryDefinitionDataset(Dataset):
         return example
 
     def __init__(
-        self, tokenizer: PreTrainedTokenizer, args, file_path: str, splits=(1.0), split_idx=0,
+        self, tokenizer: PreTrainedTokenizer, args, file_path: str, splits=(1.0), split_idx=0, num_workers=None,
     ):
         assert os.path.isfile(file_path) or os.path.islink(file_path)
 
@@ -855,34 +869,72 @@ class BinaryDictionaryDefinitionDataset(Dataset):
             model_type=args.model_type,
             splits=splits,
             split_idx=split_idx,
+            split_hash="crc32",
             max_len=self.max_len,
+            cache_format="npy",
         )
 
-        if os.path.exists(cached_features_file) and not args.overwrite_cache:
+        # Tokens and offsets are plain .npy files so they can be memory-mapped instead of unpickled
+        cached_tokens_file = f"{cached_features_file}-tokens.npy"
+        cached_offsets_file = f"{cached_features_file}-offsets.npy"
+
+        if os.path.exists(cached_tokens_file) and os.path.exists(cached_offsets_file) and not args.overwrite_cache:
             logger.info("Loading features from cached file %s", cached_features_file)
-            with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
-            logger.info("Loaded {len(self.examples)} features")
+            self._tokens = np.load(cached_tokens_file, mmap_mode="r")
+            self._offsets = np.load(cached_offsets_file, mmap_mode="r")
+            logger.info(f"Loaded {len(self)} features")
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
             split_range = _split_range(splits, split_idx)
-            self.examples = []
+            titles = []
+            trainable_entries = []
 
             with open(file_path, "rb") as f:
-                for dd in dictionary_definition.DictionaryDefinition.gen_from_apple_dictionary(f):
-                    if _in_split_range(split_range, dd.title):
-                        self.examples.append(self._make_example(tokenizer, dd))
+                dds = dictionary_definition.DictionaryDefinition.gen_from_apple_dictionary(
+                    f,
+                    num_workers=num_workers,
+                    predicate=functools.partial(_in_split_range, split_range),
+                    parse_entry=False,
+                )
+                for dd in dds:
+                    titles.append(dd.title)
+                    trainable_entries.append(self._trainable_entry(dd))
+
+            # Tokenize everything in two batch calls, which fast tokenizers run in a single native call. Headwords
+            # repeat across variants and senses, so each distinct title is only tokenized once.
+            unique_titles = list(dict.fromkeys(titles))
+            title_token_ids = dict(
+                zip(
+                    unique_titles,
+                    tokenizer.batch_encode_plus(
+                        [self.title_tokenization(title) for title in unique_titles], add_special_tokens=False
+                    )["input_ids"],
+                )
+            )
+            tokenized_titles = [title_token_ids[title] for title in titles]
+            tokenized_entries = tokenizer.batch_encode_plus(trainable_entries, add_special_tokens=False)["input_ids"]
 
-            logger.info(f"Saving {len(self.examples)} features into cached file {cached_features_file}")
-            with open(cached_features_file, "wb") as handle:
-                pickle.dump(self.examples, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            examples = [
+                np.asarray(self._make_example(tokenizer, title, tokenized_title, tokenized_entry), dtype=np.int32)
+                for title, tokenized_title, tokenized_entry in zip(titles, tokenized_titles, tokenized_entries)
+            ]
+
+            # Examples are stored as one flat token array plus offsets rather than a list of lists so the cache
+            # doesn't have to round-trip millions of python ints
+            self._tokens = np.concatenate(examples) if examples else np.zeros(0, dtype=np.int32)
+            self._offsets = np.cumsum([0] + [len(e) for e in examples], dtype=np.int64)
+
+            logger.info(f"Saving {len(self)} features into cached file {cached_features_file}")
+            np.save(cached_tokens_file, self._tokens, allow_pickle=False)
+            np.save(cached_offsets_file, self._offsets, allow_pickle=False)
 
     def __len__(self):
-        return len(self.examples)
+        return len(self._offsets) - 1
 
     def __getitem__(self, item):
-        return torch.tensor(self.examples[item], dtype=torch.long)
+        start, end = self._offsets[item], self._offsets[item + 1]
+        return torch.from_numpy(self._tokens[start:end].astype(np.int64))
 
 
 class UrbanDictionaryDataset(Dataset):
@@ -928,6 +980,7 @@ class UrbanDictionaryDataset(Dataset):
             model_type=args.model_type,
             splits=splits,
             split_idx=split_idx,
+            split_hash="crc32",
             max_len=self.max_len,
         )
 
@@ -1026,9 +1079,10 @@ class WikiArticleTitleDataset(Dataset):
         example = tokenizer.build_inputs_with_special_tokens(text_tokens + title_tokens)
         start_title_idx = next(i for i in reversed(range(len(example))) if example[i] == title_tokens[0])
         end_title_idx = start_title_idx + len(title_tokens)
-        bool_mask = [bool(i > start_title_idx and i < end_title_idx) for i in range(len(example))]
+        idx = np.arange(len(example))
+        bool_mask = (idx > start_title_idx) & (idx < end_title_idx)
 
-        return (example, bool_mask)
+        return (np.asarray(example, dtype=np.int32), bool_mask)
 
     def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512):
         assert os.path.isfile(file_path)
@@ -1043,7 +1097,11 @@ class WikiArticleTitleDataset(Dataset):
         if os.path.exists(cached_features_file) and not args.overwrite_cache:
             logger.info("Loading features from cached file %s", cached_features_file)
             with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
+                # Older caches hold python lists; convert once here so __getitem__ doesn't go through torch.tensor
+                self.examples = [
+                    (np.asarray(example, dtype=np.int32), np.asarray(bool_mask, dtype=np.bool_))
+                    for example, bool_mask in pickle.load(handle)
+                ]
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
@@ -1076,7 +1134,5 @@ class WikiArticleTitleDataset(Dataset):
         return len(self.examples)
 
     def __getitem__(self, item):
-        return (
-            torch.tensor(self.examples[item][0], dtype=torch.long),
-            torch.tensor(self.examples[item][1], dtype=torch.bool),
-        )
+        example, bool_mask = self.examples[item]
+        return (torch.from_numpy(example).long(), torch.from_numpy(bool_mask))
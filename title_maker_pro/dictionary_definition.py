@@ -2,9 +2,12 @@ from struct import unpack
 from zlib import decompress
 import sys
 import re
+import itertools
+import html
 import hashlib
-import bs4
-from dataclasses import dataclass
+from lxml import etree
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
 from torch.utils.data import Dataset
 from transformers import PreTrainedTokenizer
 import logging
@@ -16,19 +19,82 @@ from typing import Optional, List, Tuple
 logger = logging.getLogger(__name__)
 
 
-# Helpers for beautiful soup
-def find_at_most_one(bs, *args, **kwargs):
-    t = bs.find_all(*args, **kwargs)
+APPLE_DICT_NS = "http://www.apple.com/DTDs/DictionaryService-1.0.rng"
+_XPATH_NAMESPACES = {"d": APPLE_DICT_NS}
+_XML_PARSER = etree.XMLParser(recover=True)
+_ROOT_OPEN = f'<root xmlns:d="{APPLE_DICT_NS}">'.encode()
+_ROOT_CLOSE = b"</root>"
+
+_ENTRY_START = b"<d:entry"
+_TITLE_RE = re.compile(rb'd:title="(.*?)"')
+
+
+class _TextTarget:
+    # Parser target that only keeps character data, giving the same text as itertext() without building a tree
+    def __init__(self):
+        self._parts = []
+
+    def start(self, tag, attrib):
+        pass
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        self._parts.append(data)
+
+    def close(self):
+        text = "".join(self._parts)
+        self._parts = []
+        return text
+
+
+_TEXT_PARSER = etree.XMLParser(target=_TextTarget(), recover=True)
+
+
+# Helpers for lxml
+def has_class(class_name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def get_text(el):
+    return "".join(el.itertext())
+
+
+def get_classes(el):
+    return el.get("class", "").split()
+
+
+def to_str(el):
+    return etree.tostring(el, encoding="unicode")
+
+
+def span_xpath(class_name, axis=".//"):
+    return etree.XPath(f"{axis}span[{has_class(class_name)}]")
+
+
+# The find_* helpers take precompiled etree.XPath objects so expressions are only compiled once
+def find_all(el, xpath):
+    return xpath(el)
+
+
+def find_first(el, xpath):
+    t = find_all(el, xpath)
+    return t[0] if t else None
+
+
+def find_at_most_one(el, xpath):
+    t = find_all(el, xpath)
     if not t:
-        return t
+        return None
     elif len(t) > 1:
         raise InvalidParseAssumptionError("Too many found!")
     else:
         return t[0]
 
 
-def find_exactly_one(bs, *args, **kwargs):
-    t = bs.find_all(*args, **kwargs)
+def find_exactly_one(el, xpath):
+    t = find_all(el, xpath)
     if not t:
         raise InvalidParseAssumptionError("Not enough tags found!")
     elif len(t) > 1:
@@ -37,8 +103,8 @@ def find_exactly_one(bs, *args, **kwargs):
         return t[0]
 
 
-def find_at_least_one(bs, *args, **kwargs):
-    t = bs.find_all(*args, **kwargs)
+def find_at_least_one(el, xpath):
+    t = find_all(el, xpath)
     if not t:
         raise InvalidParseAssumptionError("Not enough tags found!")
     return t
@@ -92,86 +158,270 @@ class Entry:
 class DictionaryDefinition:
     title: str
     entry_str: str
-    parsed_entry: Optional[bs4.BeautifulSoup] = None
+    parsed_entry: Optional[etree._Element] = None
 
     @classmethod
-    def gen_from_apple_dictionary(cls, f):
+    def gen_from_apple_dictionary(cls, f, num_workers=None, predicate=None, parse_entry=True):
+        # predicate is checked against each title before the entry is parsed, so filtered out entries cost
+        # (almost) nothing. Without parse_entry only the entry text is extracted and no tree is kept around.
+        if num_workers:
+            # Chunks are independent, so decompress and parse them in a process pool. Workers reopen f by name, so
+            # it must be a named file, and predicate must be picklable. lxml trees can't be pickled back to us, so
+            # pool mode requires parse_entry=False.
+            if parse_entry:
+                raise ValueError("parse_entry=True is not supported with num_workers")
+
+            offsets = _read_apple_dictionary_chunk_offsets(f)
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                chunk_entries = executor.map(
+                    _parse_apple_dictionary_chunk_at,
+                    itertools.repeat(f.name),
+                    [offset for offset, _ in offsets],
+                    [sz for _, sz in offsets],
+                    itertools.repeat(predicate),
+                    chunksize=4,
+                )
+                for entries in chunk_entries:
+                    for title, entry_str in entries:
+                        yield cls(title=title, entry_str=entry_str)
+            return
+
         f.seek(0x40)
         limit = 0x40 + unpack("i", f.read(4))[0]
         f.seek(0x60)
+        # Compressed chunks are read into one reusable buffer to avoid a fresh allocation (and slice copy) per chunk
+        raw = bytearray()
         while f.tell() < limit:
             (sz,) = unpack("i", f.read(4))
-            buf = decompress(f.read(sz)[8:])
-            for m in re.finditer(b"<d:entry[^\n]+", buf):
-                entry = m.group().decode()
-                title = re.search('d:title="(.*?)"', entry).group(1)
-                title_soup = bs4.BeautifulSoup(title, features="html.parser")
-                entry_soup = bs4.BeautifulSoup(entry, features="html.parser")
-
-                title = title_soup.get_text()
-                entry = entry_soup.get_text()
-
-                if not title or not entry:
-                    logger.warning(f"Invalid entry {title}: {entry}")
-                    continue
-
+            if len(raw) < sz:
+                raw = bytearray(sz)
+            view = memoryview(raw)[:sz]
+            f.readinto(view)
+            buf = decompress(view[8:])
+            for title, entry_str, root in _gen_apple_dictionary_chunk_entries(buf, predicate, parse_entry):
                 yield cls(
-                    title=title_soup.get_text(), entry_str=entry_soup.get_text(), parsed_entry=entry_soup,
+                    title=title, entry_str=entry_str, parsed_entry=root,
                 )
 
 
+def _read_apple_dictionary_chunk_offsets(f):
+    f.seek(0x40)
+    limit = 0x40 + unpack("i", f.read(4))[0]
+    f.seek(0x60)
+    offsets = []
+    while f.tell() < limit:
+        (sz,) = unpack("i", f.read(4))
+        offsets.append((f.tell(), sz))
+        f.seek(sz, os.SEEK_CUR)
+    return offsets
+
+
+def _gen_entry_lines(buf):
+    # Yields the same spans as re.finditer(rb"<d:entry[^\n]+", buf) using bytes.find, which scans with memchr/memmem
+    # instead of stepping the regex engine through every byte
+    i = buf.find(_ENTRY_START)
+    while i >= 0:
+        j = buf.find(b"\n", i)
+        if j < 0:
+            j = len(buf)
+
+        if j > i + len(_ENTRY_START):
+            yield buf[i:j]
+            i = buf.find(_ENTRY_START, j)
+        else:
+            i = buf.find(_ENTRY_START, i + 1)
+
+
+def _gen_apple_dictionary_chunk_entries(buf, predicate=None, parse_entry=True):
+    for entry_bytes in _gen_entry_lines(buf):
+        # d:title is an attribute value, so decoding its entities is all the parsing it needs
+        title = html.unescape(_TITLE_RE.search(entry_bytes).group(1).decode())
+        if predicate is not None and not predicate(title):
+            continue
+
+        # Wrap the fragment so the d: prefix resolves even when the entry doesn't declare it
+        wrapped_entry = _ROOT_OPEN + entry_bytes + _ROOT_CLOSE
+        if parse_entry:
+            root = etree.fromstring(wrapped_entry, _XML_PARSER)
+            entry = get_text(root)
+        else:
+            root = None
+            entry = etree.fromstring(wrapped_entry, _TEXT_PARSER)
+
+        if not title or not entry:
+            logger.warning(f"Invalid entry {title}: {entry}")
+            continue
+
+        yield title, entry, root
+
+
+def _parse_apple_dictionary_chunk_at(path, offset, sz, predicate):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        raw = f.read(sz)
+    buf = decompress(memoryview(raw)[8:])
+    return [
+        (title, entry_str)
+        for title, entry_str, _ in _gen_apple_dictionary_chunk_entries(buf, predicate, parse_entry=False)
+    ]
+
+
+@dataclass
+class _DefinitionSpans:
+    span: etree._Element
+    date_spans: List[etree._Element] = field(default_factory=list)
+
+
+@dataclass
+class _ReferenceSpans:
+    span: etree._Element
+    referenced_term_spans: List[etree._Element] = field(default_factory=list)
+
+
+@dataclass
+class _MsDictSpans:
+    span: etree._Element
+    local_pos_modifier_span: Optional[etree._Element] = None
+    definitions: List[_DefinitionSpans] = field(default_factory=list)
+    example_spans: List[etree._Element] = field(default_factory=list)
+    topic_spans: List[etree._Element] = field(default_factory=list)
+    references: List[_ReferenceSpans] = field(default_factory=list)
+
+
+_XP_SELF_OR_ANCESTOR_MSDICT = span_xpath("msDict", axis="ancestor-or-self::")
+_XP_SELF_OR_ANCESTOR_EG = span_xpath("eg", axis="ancestor-or-self::")
+_SENSE_CLASSES = frozenset(("gg", "msDict", "df", "dg", "ex", "lg", "eg", "xrg", "xr"))
+
+
+def _collect_sense_spans(parsed_entry):
+    # Classifies every span relevant to sense definitions in a single depth-first walk rather than re-searching
+    # each msDict subtree per class. A span is attributed to every enclosing msDict/df/xrg, like find_all would.
+    global_pos_modifier_spans = []
+    msdicts = []
+
+    def walk(el, open_msdicts, open_definitions, open_references, in_msdict, in_eg):
+        for c in el.iterchildren(etree.Element):
+            classes = _SENSE_CLASSES.intersection(get_classes(c)) if c.tag == "span" else ()
+            child_msdicts, child_definitions, child_references = open_msdicts, open_definitions, open_references
+            child_in_msdict, child_in_eg = in_msdict, in_eg
+
+            if classes:
+                if "gg" in classes:
+                    if not in_msdict:
+                        global_pos_modifier_spans.append(c)
+                    elif open_msdicts and open_msdicts[-1].span is el:
+                        if open_msdicts[-1].local_pos_modifier_span is None:
+                            open_msdicts[-1].local_pos_modifier_span = c
+                if "df" in classes:
+                    definition = _DefinitionSpans(span=c)
+                    for msdict in open_msdicts:
+                        msdict.definitions.append(definition)
+                    child_definitions = open_definitions + [definition]
+                if "dg" in classes:
+                    for definition in open_definitions:
+                        definition.date_spans.append(c)
+                if "ex" in classes:
+                    for msdict in open_msdicts:
+                        msdict.example_spans.append(c)
+                if "lg" in classes and not in_eg:
+                    for msdict in open_msdicts:
+                        msdict.topic_spans.append(c)
+                if "eg" in classes:
+                    child_in_eg = True
+                if "xrg" in classes:
+                    reference = _ReferenceSpans(span=c)
+                    for msdict in open_msdicts:
+                        msdict.references.append(reference)
+                    child_references = open_references + [reference]
+                if "xr" in classes:
+                    for reference in open_references:
+                        reference.referenced_term_spans.append(c)
+                if "msDict" in classes:
+                    msdict = _MsDictSpans(span=c)
+                    msdicts.append(msdict)
+                    child_msdicts = open_msdicts + [msdict]
+                    child_in_msdict = True
+
+            walk(c, child_msdicts, child_definitions, child_references, child_in_msdict, child_in_eg)
+
+    # Spans above parsed_entry still count when deciding whether a pos modifier is local or a topic is an example's
+    in_msdict = bool(find_all(parsed_entry, _XP_SELF_OR_ANCESTOR_MSDICT))
+    in_eg = bool(find_all(parsed_entry, _XP_SELF_OR_ANCESTOR_EG))
+    walk(parsed_entry, [], [], [], in_msdict, in_eg)
+
+    return global_pos_modifier_spans, msdicts
+
+
 class AppleDictParser:
+    _XP_ENTRY = etree.XPath(".//d:entry", namespaces=_XPATH_NAMESPACES)
+    _XP_CHILD_TG_ETYM = span_xpath("tg_etym", axis="./")
+    _XP_HG = span_xpath("hg")
+    _XP_HW = span_xpath("hw")
+    _XP_L = span_xpath("l")
+    _XP_MSDICT = span_xpath("msDict")
+    _XP_PH = span_xpath("ph")
+    _XP_POSG = span_xpath("posg")
+    _XP_PR = span_xpath("pr")
+    _XP_PRX = span_xpath("prx")
+    _XP_SE1 = span_xpath("se1")
+    _XP_SE2 = span_xpath("se2")
+    _XP_SG = span_xpath("sg")
+    _XP_SUBENTRY = span_xpath("subEntry")
+    _XP_TG_HW = span_xpath("tg_hw")
+    _XP_TG_POS = span_xpath("tg_pos")
+    _XP_X_XO1 = span_xpath("x_xo1")
+    _XP_X_XOH = span_xpath("x_xoh")
+    _XP_X_XOT = span_xpath("x_xot")
+
     @classmethod
     def parse_pronounciations(cls, parsed_entry):
-        pronounciation_encloses = [e for e in parsed_entry.find_all("span", class_="prx") if e.get_text().strip()]
+        pronounciation_encloses = [e for e in find_all(parsed_entry, cls._XP_PRX) if get_text(e).strip()]
         if len(pronounciation_encloses) == 0:
-            pronounciation_encloses = [e for e in parsed_entry.find_all("span", class_="pr") if e.get_text().strip()]
+            pronounciation_encloses = [e for e in find_all(parsed_entry, cls._XP_PR) if get_text(e).strip()]
 
         if not pronounciation_encloses:
             return None
 
         ret = []
         for pronounciation_enclose in pronounciation_encloses:
-            pronounciations = pronounciation_enclose("span", class_="ph")
+            pronounciations = find_all(pronounciation_enclose, cls._XP_PH)
             if not pronounciations:
                 raise InvalidParseAssumptionError(f"No pronounciations found")
 
-            ret.extend([Pronounciation(text=p.get_text(), type=p["d:pr"]) for p in pronounciations])
+            ret.extend(
+                [Pronounciation(text=get_text(p), type=p.get(f"{{{APPLE_DICT_NS}}}pr")) for p in pronounciations]
+            )
         return ret
 
     @classmethod
     def parse_sense_definitions(cls, parsed_entry):
-        global_pos_modifier_span = parsed_entry.find_all("span", class_="gg")
-        global_pos_modifier_span = [
-            e for e in global_pos_modifier_span if not e.find_parents("span", class_="msDict")
-        ]  # Filter out local ones
-        global_pos_modifier = global_pos_modifier_span[0].get_text().strip() if global_pos_modifier_span else None
+        global_pos_modifier_spans, msdicts = _collect_sense_spans(parsed_entry)
+        global_pos_modifier = get_text(global_pos_modifier_spans[0]).strip() if global_pos_modifier_spans else None
         definitions = []
-        entry_spans = find_at_least_one(parsed_entry, "span", class_="msDict")
-        for entry_span in entry_spans:
-            if not entry_span.get_text().strip().strip("•"):  # Some malformed entries, e.g. thrash
+        if not msdicts:
+            raise InvalidParseAssumptionError("Not enough tags found!")
+
+        for msdict in msdicts:
+            entry_span = msdict.span
+            if not get_text(entry_span).strip().strip("•"):  # Some malformed entries, e.g. thrash
                 continue
 
-            definition_spans = entry_span.find_all("span", class_="df")
-            xrg_spans = entry_span.find_all("span", class_="xrg")
-            if definition_spans:
-                for definition_span in definition_spans:
-                    example_spans = entry_span("span", class_="ex")
-                    topic_spans = [
-                        e for e in entry_span("span", class_="lg") if not e.find_parents("span", class_="eg")
-                    ]
+            if msdict.definitions:
+                for definition_spans in msdict.definitions:
+                    topic_spans = msdict.topic_spans
                     if len(topic_spans) > 1:
                         logging.warning(f"Too many topics found: {topic_spans}, picking first one")
 
-                    local_pos_modifier_span = entry_span.find("span", class_="gg", recursive=False)
-                    local_pos_modifier = local_pos_modifier_span and local_pos_modifier_span.get_text().strip()
+                    local_pos_modifier_span = msdict.local_pos_modifier_span
+                    local_pos_modifier = (
+                        local_pos_modifier_span is not None and get_text(local_pos_modifier_span).strip()
+                    )
 
-                    definition = definition_span.get_text().strip()
-                    examples = [e.get_text().strip().strip(":").strip() for e in example_spans]
-                    topic = topic_spans and topic_spans[0].get_text().strip()
+                    definition = get_text(definition_spans.span).strip()
+                    examples = [get_text(e).strip().strip(":").strip() for e in msdict.example_spans]
+                    topic = topic_spans and get_text(topic_spans[0]).strip()
 
-                    date_spans = definition_span("span", class_="dg")
-                    dates = [e.get_text().strip() for e in date_spans]
+                    dates = [get_text(e).strip() for e in definition_spans.date_spans]
 
                     definitions.append(
                         Definition(
@@ -182,46 +432,48 @@ class AppleDictParser:
                             dates=dates,
                         )
                     )
-            elif xrg_spans:
-                for xrg in xrg_spans:
-                    referenced_terms = find_at_least_one(xrg, "span", class_="xr")
+            elif msdict.references:
+                for reference_spans in msdict.references:
+                    if not reference_spans.referenced_term_spans:
+                        raise InvalidParseAssumptionError("Not enough tags found!")
 
-                    for referenced_term in referenced_terms:
-                        reference = referenced_term.get_text().strip()
+                    for referenced_term in reference_spans.referenced_term_spans:
+                        reference = get_text(referenced_term).strip()
                         definitions.append(ReferenceDefinition(pos_modifier=global_pos_modifier, reference=reference,))
-            elif entry_span.find("span", class_="ex"):
-                logger.warning(f"Silently ignoring example without corresponding definition {entry_span}")
+            elif msdict.example_spans:
+                logger.warning(f"Silently ignoring example without corresponding definition {to_str(entry_span)}")
             else:
-                raise InvalidParseAssumptionError(f"Weird span: {entry_span}")
+                raise InvalidParseAssumptionError(f"Weird span: {to_str(entry_span)}")
 
         return definitions
 
     @classmethod
     def parse_sense(cls, parsed_entry):
-        pos_spans = parsed_entry("span", class_="tg_pos")
+        pos_spans = find_all(parsed_entry, cls._XP_TG_POS)
         if len(pos_spans) > 1:
-            pos = " ".join([e.get_text().strip() for e in pos_spans])
+            pos = " ".join([get_text(e).strip() for e in pos_spans])
         elif not pos_spans:
-            pos_span = find_at_most_one(parsed_entry, "span", class_="posg")
-            pos = pos_span.get_text().strip() if pos_span else None
+            pos_span = find_at_most_one(parsed_entry, cls._XP_POSG)
+            pos = get_text(pos_span).strip() if pos_span is not None else None
         else:
-            pos = pos_spans[0].get_text().strip()
+            pos = get_text(pos_spans[0]).strip()
 
-        if parsed_entry.findChildren("span", class_="se2"):
+        if find_all(parsed_entry, cls._XP_SE2):
             sense_definitions = []
-            for c in parsed_entry.children:
-                if set(c["class"]) & set(("tg_pos", "posg", "x_xdh")):
+            for c in parsed_entry.iterchildren(etree.Element):
+                classes = get_classes(c)
+                if set(classes) & set(("tg_pos", "posg", "x_xdh")):
                     continue
-                elif not c.get_text().strip():
+                elif not get_text(c).strip():
                     continue
-                elif "se2" in c["class"]:
+                elif "se2" in classes:
                     sense_definitions.extend(cls.parse_sense_definitions(c))
-                elif "note" in c["class"]:
-                    logger.warning(f"Dropping note in word sense {c}")
-                elif "msDict" in c["class"]:
-                    logger.warning(f"Dropping unexpected msDict in sense {c}")
+                elif "note" in classes:
+                    logger.warning(f"Dropping note in word sense {to_str(c)}")
+                elif "msDict" in classes:
+                    logger.warning(f"Dropping unexpected msDict in sense {to_str(c)}")
                 else:
-                    raise InvalidParseAssumptionError(f"WEIRD TAG: {c}")
+                    raise InvalidParseAssumptionError(f"WEIRD TAG: {to_str(c)}")
         else:
             sense_definitions = cls.parse_sense_definitions(parsed_entry)
 
@@ -231,79 +483,82 @@ class AppleDictParser:
 
     @classmethod
     def parse_derivatives(cls, parsed_entry):
-        words = find_at_least_one(parsed_entry, "span", class_="l")
-        return [e.get_text().strip() for e in words]
+        words = find_at_least_one(parsed_entry, cls._XP_L)
+        return [get_text(e).strip() for e in words]
 
     @classmethod
     def parse_origin(cls, parsed_entry):
-        etym_type = find_exactly_one(parsed_entry, "span", class_="tg_etym", recursive=False)
-        if etym_type.get_text().strip() != "ORIGIN":
-            raise InvalidParseAssumptionError(f"Unexpected etym type: {etym_type}")
+        etym_type = find_exactly_one(parsed_entry, cls._XP_CHILD_TG_ETYM)
+        if get_text(etym_type).strip() != "ORIGIN":
+            raise InvalidParseAssumptionError(f"Unexpected etym type: {to_str(etym_type)}")
 
-        origin_span = find_exactly_one(parsed_entry, "span", class_="x_xo1")
-        origin = origin_span.get_text().strip()
+        origin_span = find_exactly_one(parsed_entry, cls._XP_X_XO1)
+        origin = get_text(origin_span).strip()
         return origin
 
     @classmethod
     def parse_phrasal_verbs(cls, parsed_entry):
-        subentries = find_at_least_one(parsed_entry, "span", class_="subEntry")
+        subentries = find_at_least_one(parsed_entry, cls._XP_SUBENTRY)
         ret = []
         for subentry in subentries:
-            word_span = subentry.find("span", class_="x_xoh") or subentry.find("span", class_="x_xot")
-            if subentry.find("span", class_="msDict"):
+            word_span = find_first(subentry, cls._XP_X_XOH)
+            if word_span is None:
+                word_span = find_first(subentry, cls._XP_X_XOT)
+            if find_all(subentry, cls._XP_MSDICT):
                 definitions = cls.parse_sense_definitions(subentry)
             else:
                 definitions = []
-            ret.append((word_span.get_text().strip(), definitions))
+            ret.append((get_text(word_span).strip(), definitions))
         return ret
 
     @classmethod
     def parse(cls, parsed_entry):
-        entry = find_exactly_one(parsed_entry, "d:entry")
-        head_entry = find_exactly_one(entry, "span", class_="hg")
-        defn_entry = find_exactly_one(entry, "span", class_="sg")
+        entry = find_exactly_one(parsed_entry, cls._XP_ENTRY)
+        head_entry = find_exactly_one(entry, cls._XP_HG)
+        defn_entry = find_exactly_one(entry, cls._XP_SG)
 
-        head_word_span = find_exactly_one(head_entry, "span", class_="hw")
-        word = " ".join([t.strip() for t in head_word_span.contents if type(t) == bs4.element.NavigableString]).strip()
+        head_word_span = find_exactly_one(head_entry, cls._XP_HW)
+        head_word_strings = [head_word_span.text] + [c.tail for c in head_word_span]
+        word = " ".join([t.strip() for t in head_word_strings if t is not None]).strip()
 
-        variant_span = find_at_most_one(head_word_span, "span", class_="tg_hw")
-        variant = int(variant_span.get_text()) if variant_span else None
+        variant_span = find_at_most_one(head_word_span, cls._XP_TG_HW)
+        variant = int(get_text(variant_span)) if variant_span is not None else None
 
         pronounciations = cls.parse_pronounciations(head_entry)
 
-        senses = defn_entry("span", class_="se1")
+        senses = find_all(defn_entry, cls._XP_SE1)
         if len(senses) == 0:
             raise InvalidParseAssumptionError(f"No senses found!")
 
         senses = []
-        for c in defn_entry.children:
-            if "se1" in c["class"]:
+        for c in defn_entry.iterchildren(etree.Element):
+            if "se1" in get_classes(c):
                 senses.append(cls.parse_sense(c))
-            elif c.get_text().strip():
-                raise InvalidParseAssumptionError(f"Weird tag found in definition: {c.prettify()}!")
+            elif get_text(c).strip():
+                raise InvalidParseAssumptionError(f"Weird tag found in definition: {to_str(c)}!")
 
         phrases = []
         origin = None
-        subentries = entry.find_all("span", class_="t_derivatives")  # derivatives # TODO: verify
         derivatives = []
         phrasal_verbs = []
         notes = []
 
-        for subentry in entry.children:
-            if subentry == head_entry or subentry == defn_entry:
+        for subentry in entry.iterchildren(etree.Element):
+            classes = get_classes(subentry)
+            if subentry is head_entry or subentry is defn_entry:
                 continue
-            elif "t_phrases" in subentry["class"]:
+            elif "t_phrases" in classes:
                 phrases = cls.parse_sense_definitions(subentry)
-            elif "t_derivatives" in subentry["class"]:
+            elif "t_derivatives" in classes:
                 derivatives = cls.parse_derivatives(subentry)
-            elif "t_phrasalVerbs" in subentry["class"]:
+            elif "t_phrasalVerbs" in classes:
                 phrasal_verbs = cls.parse_phrasal_verbs(subentry)
-            elif "etym" in subentry["class"]:
+            elif "etym" in classes:
                 origin = cls.parse_origin(subentry)
-            elif "note" in subentry["class"]:
-                notes.append(subentry.get_text())
+            elif "note" in classes:
+                notes.append(get_text(subentry))
             else:
-                raise InvalidParseAssumptionError(f"Weird entry found: {subentry}")
+                raise InvalidParseAssumptionError(f"Weird entry found: {to_str(subentry)}")
 
         # TODO: determine other direct children types
         return Entry(
@@ -319,6 +574,25 @@ class AppleDictParser:
         )
 
 
+def _split_generated_title(decoded):
+    # Equivalent to re.search(r"<title>(.*?)</title>(.*)", decoded) but with plain string scans, which
+    # avoids backtracking over the malformed samples that are common during generation
+    i = decoded.find("<title>")
+    while i >= 0:
+        j = decoded.find("</title>", i + 7)
+        if j < 0:
+            return None
+
+        title = decoded[i + 7 : j]
+        if "\n" not in title:
+            end = decoded.find("\n", j + 8)
+            return title, decoded[j + 8 :] if end < 0 else decoded[j + 8 : end]
+
+        i = decoded.find("<title>", i + 7)
+
+    return None
+
+
 def generate_words(
     tokenizer,
     model,
@@ -338,22 +612,30 @@ def generate_words(
     while len(ret) < num and num_iteration < max_iterations:
         num_iteration += 1
 
-        generated = model.generate(input, max_length=max_length, num_return_sequences=batch_size, temperature=1.0,)
-        valid_i = 0
+        generated = model.generate(
+            input,
+            max_length=max_length,
+            num_return_sequences=batch_size,
+            temperature=1.0,
+            do_sample=True,
+            num_beams=1,
+            pad_token_id=tokenizer.eos_token_id,
+        )
 
-        for i in range(generated.size()[0]):
-            sentence_tokens = generated[i, :].tolist()
+        # One device-to-host copy for the whole batch rather than one per generated row
+        for sentence_tokens in generated.tolist():
             decoded = tokenizer.decode(sentence_tokens)
-            m = re.search(r"<title>(.*?)</title>(.*)", decoded)
+            m = _split_generated_title(decoded)
             if m:
-                title = m.group(1).strip()
+                title, entry_str = m
+                title = title.strip()
                 if not allow_proper_nouns and title[:1].upper() == title[:1]:
                     continue
                 elif title.upper() in blacklist or title.upper().rstrip("s") in blacklist:
                     continue
                 else:
-                    ret.append(DictionaryDefinition(title=title, entry_str=m.group(2).rstrip("!")))
+                    ret.append(DictionaryDefinition(title=title, entry_str=entry_str.rstrip("!")))
             else:
-                logger.warning(f'Unable to match regex in "{decoded}"')
+                logger.warning(f'Unable to find title in "{decoded}"')
 
     return ret
@@ -185,6 +185,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False):
             file_path=file_path,
             splits=[float(e) for e in args.splits],
             split_idx=int(args.eval_split_idx if evaluate else args.train_split_idx),
+            num_workers=args.dictionary_num_workers,
         )
     elif args.urban_dictionary_dataset:
         return datasets.UrbanDictionaryDataset(
@@ -644,6 +645,11 @@ def main():
     parser.add_argument(
         "--dictionary_dataset", action="store_true", help="Whether this is a dictionary dataset",
     )
+    parser.add_argument(
+        "--dictionary_num_workers",
+        type=int,
+        help="Number of processes used to parse a dictionary dataset (parsed serially if unset)",
+    )
     parser.add_argument(
         "--parsed_dictionary_dataset", action="store_true", help="Whether this is a parsed dictionary dataset",
     )